@@ -1,28 +1,105 @@
 #!/usr/bin/env python3
 import base64
+import functools
+import hashlib
 import io
 import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
 
-from flask import Flask, render_template, request, send_file
-from werkzeug.utils import secure_filename
+from flask import Flask, abort, render_template, request, send_file, url_for
+import numpy as np
 import qrcode
-from qrcode.image.svg import SvgImage
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance, ImageOps
+from qrcode import util as qr_util
+from PIL import Image, ImageColor, ImageDraw, ImageFont, ImageEnhance, ImageOps
+
+try:
+    # SIMD base64 encoder, noticeably faster on large PNGs
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(s) -> str:
+        return base64.b64encode(s).decode("ascii")
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB max
 
-# Create uploads directory
-os.makedirs('uploads', exist_ok=True)
-
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
+# Uploads are downscaled to fit this box on arrival; every personalization
+# mode draws them smaller than this at typical sizes
+UPLOAD_MAX_SIZE = (1024, 1024)
+
+# Every code uses the highest error correction so decorations stay scannable
+ERROR_CORRECTION = qrcode.constants.ERROR_CORRECT_H
+
+# Fixed data mask for plain codes, where any of the 8 masks scans; letting
+# qrcode score all of them is ~90% of encoding time. Decorated codes keep
+# the search: frames and text over a fixed mask can make small codes
+# unreadable. Set to None to search for every code.
+MASK_PATTERN = 1
+
+# Rendered QR codes kept in memory for repeated submissions, bounded by
+# total payload size as well as count. Decorated codes at box_size 40 run
+# to a few MB each, so larger payloads are rendered afresh every time.
+QR_CACHE_SIZE = 256
+QR_CACHE_BYTES = 32 * 1024 * 1024
+QR_CACHE_MAX_ENTRY = 1024 * 1024
+
+# Renders keyed by an upload are almost never requested twice (each photo
+# has its own digest), so only a few of them are kept
+UPLOAD_CACHE_SIZE = 8
+UPLOAD_CACHE_BYTES = 4 * 1024 * 1024
+
+# Colourless module images (one pixel per module) kept for decorated codes
+MONO_CACHE_SIZE = 256
+
+# zlib level for PNG output; 1 is nearly as small as the default 6 for QR
+# codes and much faster to encode
+PNG_COMPRESS_LEVEL = 1
+
+# Longest /qr.png link handed to the browser; longer payloads (or uploads,
+# which a URL can't carry) are embedded as data URLs instead. Keeps well
+# under gunicorn's 4094-byte request line limit.
+MAX_QR_URL_LENGTH = 2048
+
+# Form values shown on a fresh page
+FORM_DEFAULTS = {
+    "input_data": "",
+    "box_size": 10,
+    "border": 4,
+    "fg_color": "#000000",
+    "bg_color": "#ffffff",
+    "transparent_bg": False,
+    "image_format": "png",
+    "style_preset": "classic",
+    "add_frame": True,
+    "personalization_mode": "none",
+    "content_type": "text",
+    "initials": "",
+}
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def load_upload(file):
+    """
+    Decode an uploaded image straight from the request stream, shrunk once
+    to UPLOAD_MAX_SIZE so the decorators never resample a full-size photo.
+    Returned as an UploadedContent keyed by the sha256 of the file's bytes.
+    """
+    digest = hashlib.file_digest(file.stream, "sha256").digest()
+    file.stream.seek(0)
+    img = Image.open(file.stream)
+    # Before load() so JPEGs can be decoded at reduced scale
+    img.thumbnail(UPLOAD_MAX_SIZE, Image.Resampling.LANCZOS)
+    img.load()
+    return UploadedContent(img, digest)
+
+
 def hex_or_default(value: str, default: str) -> str:
     """Very small sanity check for hex colors."""
     if not value:
@@ -35,17 +112,90 @@ def hex_or_default(value: str, default: str) -> str:
     return value
 
 
-def png_to_base64(img) -> str:
+def int_or_default(value, default: int, lo: int, hi: int) -> int:
+    """Parse a form integer, clamped to [lo, hi]; bad input gives the default."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(lo, min(hi, value))
+
+
+def encode_png(img, compress_level: int = PNG_COMPRESS_LEVEL) -> bytes:
     buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
-    buffer.seek(0)
-    img_base64 = base64.b64encode(buffer.read()).decode("ascii")
-    return f"data:image/png;base64,{img_base64}"
+    img.save(buffer, format="PNG", compress_level=compress_level, optimize=False)
+    return buffer.getvalue()
+
 
+def png_chunk(tag: bytes, data: bytes) -> tuple[bytes, ...]:
+    """Pieces of one PNG chunk, to be joined once with the rest of the file."""
+    crc = zlib.crc32(data, zlib.crc32(tag))
+    return struct.pack(">I", len(data)), tag, data, struct.pack(">I", crc)
 
-def svg_to_base64(svg_bytes: bytes) -> str:
-    img_base64 = base64.b64encode(svg_bytes).decode("ascii")
-    return f"data:image/svg+xml;base64,{img_base64}"
+
+def encode_qr_png(modules, box_size: int, border: int, fg_rgb, bg_rgb,
+                  transparent_bg: bool = False,
+                  compress_level: int = PNG_COMPRESS_LEVEL) -> bytes:
+    """
+    Write a plain QR code straight to a 1-bit palette PNG, without going
+    through a Pillow image. Each module row is packed once and repeated
+    ``box_size`` times as ready-made scanlines.
+    """
+    modules = np.pad(np.asarray(modules, dtype=np.uint8), border)
+    packed = np.packbits(modules.repeat(box_size, axis=1), axis=1)
+    height = modules.shape[0] * box_size
+    width = modules.shape[1] * box_size
+
+    # Every scanline starts with filter type 0 (None)
+    scanlines = np.zeros((modules.shape[0], packed.shape[1] + 1), dtype=np.uint8)
+    scanlines[:, 1:] = packed
+    raw = scanlines.repeat(box_size, axis=0)
+
+    parts = [b"\x89PNG\r\n\x1a\n"]
+    parts += png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 1, 3, 0, 0, 0))
+    parts += png_chunk(b"PLTE", bytes((255, 255, 255) if transparent_bg else bg_rgb) + bytes(fg_rgb))
+    if transparent_bg:
+        parts += png_chunk(b"tRNS", b"\x00")
+    # zlib reads the scanline array in place; the compressed stream is the
+    # only copy of the image data until the final join
+    parts += png_chunk(b"IDAT", zlib.compress(raw, compress_level))
+    parts += png_chunk(b"IEND", b"")
+    return b"".join(parts)
+
+
+def encode_qr_svg(modules, box_size: int, border: int, fg_rgb, bg_rgb,
+                  transparent_bg: bool = False) -> bytes:
+    """
+    Write a QR code as a single SVG path, one subpath per horizontal run of
+    dark modules. Sized like qrcode's SvgImage (box_size / 10 mm a module).
+    """
+    modules = np.asarray(modules, dtype=np.int8)
+    size = modules.shape[0] + 2 * border
+    # +1 where a dark run starts, -1 just past where it ends
+    edges = np.diff(np.pad(modules, ((0, 0), (1, 1))), axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    ends = np.nonzero(edges == -1)[1]
+    path = "".join(
+        f"M{x} {y}h{w}v1h-{w}z"
+        for y, x, w in zip((rows + border).tolist(), (starts + border).tolist(),
+                           (ends - starts).tolist())
+    )
+
+    fill = "#{:02x}{:02x}{:02x}".format(*fg_rgb)
+    background = "" if transparent_bg else (
+        '<rect width="100%" height="100%" fill="#{:02x}{:02x}{:02x}"/>'.format(*bg_rgb))
+    side = f"{size * box_size / 10:g}mm"
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{side}" height="{side}" '
+        f'viewBox="0 0 {size} {size}" shape-rendering="crispEdges">'
+        f'{background}<path fill="{fill}" d="{path}"/></svg>\n'
+    ).encode("utf-8")
+
+
+def to_data_url(payload: bytes, mimetype: str) -> str:
+    img_base64 = b64encode_as_string(payload)
+    return f"data:{mimetype};base64,{img_base64}"
 
 
 def apply_style_preset(style_preset: str, fg_color: str, bg_color: str):
@@ -69,6 +219,17 @@ def apply_style_preset(style_preset: str, fg_color: str, bg_color: str):
     return fg_color, bg_color
 
 
+@functools.lru_cache(maxsize=64)
+def load_font(name: str, size: int):
+    """Load a DejaVu font once per (name, size), falling back to Pillow's default."""
+    for path in (f"/usr/share/fonts/truetype/dejavu/{name}", name):
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError:
+            pass
+    return ImageFont.load_default()
+
+
 def make_circular(img):
     """Convert square image to circular with transparent background."""
     size = img.size
@@ -82,23 +243,17 @@ def make_circular(img):
     return output
 
 
-def add_minimal_personalization(img, content_type, content, fg_color, bg_color):
+def add_minimal_personalization(img, content_type, content, fg_rgb, bg_rgb):
     """MINIMAL MODE: Clean placement below QR."""
     width, height = img.size
     new_height = height + 100
-    canvas = Image.new('RGB', (width, new_height), bg_color)
+    canvas = Image.new('RGB', (width, new_height), bg_rgb)
     canvas.paste(img, (0, 0))
     draw = ImageDraw.Draw(canvas)
     
     if content_type == "text" and content:
         # Clean typography centered below QR
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 48)
-        except:
-            try:
-                font = ImageFont.truetype("DejaVuSans-Bold.ttf", 48)
-            except:
-                font = ImageFont.load_default()
+        font = load_font("DejaVuSans-Bold.ttf", 48)
         
         text = content.upper()
         bbox = draw.textbbox((0, 0), text, font=font)
@@ -109,8 +264,8 @@ def add_minimal_personalization(img, content_type, content, fg_color, bg_color):
         y = height + (100 - text_height) // 2
         
         # Subtle shadow
-        draw.text((x + 2, y + 2), text, fill=fg_color + "40", font=font)
-        draw.text((x, y), text, fill=fg_color, font=font)
+        draw.text((x + 2, y + 2), text, fill=fg_rgb + (0x40,), font=font)
+        draw.text((x, y), text, fill=fg_rgb, font=font)
     
     elif content_type in ["logo", "image"] and content:
         # Small centered badge
@@ -127,7 +282,7 @@ def add_minimal_personalization(img, content_type, content, fg_color, bg_color):
         # Background circle
         draw.ellipse(
             [logo_x - 5, logo_y - 5, logo_x + badge_size + 5, logo_y + badge_size + 5],
-            fill=bg_color
+            fill=bg_rgb
         )
         
         canvas.paste(logo, (logo_x, logo_y), logo if logo.mode == 'RGBA' else None)
@@ -135,22 +290,17 @@ def add_minimal_personalization(img, content_type, content, fg_color, bg_color):
     return canvas
 
 
-def add_focal_personalization(img, content_type, content, fg_color, bg_color):
+def add_focal_personalization(img, content_type, content, fg_rgb, bg_rgb, draw=None):
     """FOCAL POINT MODE: Large, prominent in center safe zone."""
     width, height = img.size
-    draw = ImageDraw.Draw(img)
+    if draw is None:
+        draw = ImageDraw.Draw(img)
     center_x, center_y = width // 2, height // 2
     safe_radius = int(min(width, height) * 0.15)
     
     if content_type == "text" and content:
         # Large stylized initials in center
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 120)
-        except:
-            try:
-                font = ImageFont.truetype("DejaVuSans-Bold.ttf", 120)
-            except:
-                font = ImageFont.load_default()
+        font = load_font("DejaVuSans-Bold.ttf", 120)
         
         text = content.upper()[:3]
         bbox = draw.textbbox((0, 0), text, font=font)
@@ -163,14 +313,14 @@ def add_focal_personalization(img, content_type, content, fg_color, bg_color):
         draw.ellipse(
             [center_x - circle_radius, center_y - circle_radius,
              center_x + circle_radius, center_y + circle_radius],
-            fill=bg_color,
-            outline=fg_color,
+            fill=bg_rgb,
+            outline=fg_rgb,
             width=4
         )
         
         text_x = center_x - text_width // 2
         text_y = center_y - text_height // 2
-        draw.text((text_x, text_y), text, fill=fg_color, font=font)
+        draw.text((text_x, text_y), text, fill=fg_rgb, font=font)
     
     elif content_type in ["logo", "image"] and content:
         # Circular logo/portrait in center
@@ -183,8 +333,8 @@ def add_focal_personalization(img, content_type, content, fg_color, bg_color):
         draw.ellipse(
             [center_x - logo_size // 2 - 10, center_y - logo_size // 2 - 10,
              center_x + logo_size // 2 + 10, center_y + logo_size // 2 + 10],
-            fill=bg_color,
-            outline=fg_color,
+            fill=bg_rgb,
+            outline=fg_rgb,
             width=6
         )
         
@@ -195,30 +345,23 @@ def add_focal_personalization(img, content_type, content, fg_color, bg_color):
     return img
 
 
-def add_easter_egg_personalization(img, content_type, content, fg_color):
+def add_easter_egg_personalization(img, content_type, content, fg_rgb, draw=None):
     """EASTER EGG MODE: Subtle, hidden, discoverable."""
     width, height = img.size
     
     if content_type == "text" and content:
-        draw = ImageDraw.Draw(img, 'RGBA')
-        try:
-            font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 8)
-        except:
-            try:
-                font = ImageFont.truetype("DejaVuSans.ttf", 8)
-            except:
-                font = ImageFont.load_default()
+        # The low-alpha text is written straight into the alpha channel
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+            draw = None
+        if draw is None:
+            draw = ImageDraw.Draw(img, 'RGBA')
+        font = load_font("DejaVuSans.ttf", 8)
         
         text = content.upper()
         
-        # Convert hex to RGBA with low alpha
-        if fg_color.startswith('#'):
-            r = int(fg_color[1:3], 16)
-            g = int(fg_color[3:5], 16)
-            b = int(fg_color[5:7], 16)
-            subtle_color = (r, g, b, 80)
-        else:
-            subtle_color = (0, 0, 0, 80)
+        # Foreground with low alpha
+        subtle_color = fg_rgb + (80,)
         
         # Multiple subtle placements
         positions = [
@@ -247,44 +390,220 @@ def add_easter_egg_personalization(img, content_type, content, fg_color):
         logo_x = (width - watermark_size) // 2
         logo_y = (height - watermark_size) // 2
         
-        img = img.convert('RGBA')
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
         img.paste(logo, (logo_x, logo_y), logo)
         img = img.convert('RGB')
     
     return img
 
 
-def decorate_png_qr(img, fg_color: str, add_frame: bool, personalization_mode: str,
-                    content_type: str, content, bg_color: str):
-    """Add decorations to PNG QR based on personalization mode."""
-    img = img.copy()
+def draws_personalization(personalization_mode: str, content_type: str, content) -> bool:
+    """Whether a personalization mode would change the image at all."""
+    if personalization_mode == "minimal":
+        return True  # always adds the strip below the code, even if empty
+    return (personalization_mode in ("focal", "easter_egg") and bool(content)
+            and content_type in ("text", "logo", "image"))
+
+
+def decorate_png_qr(img, fg_rgb: tuple, add_frame: bool, personalization_mode: str,
+                    content_type: str, content, bg_rgb: tuple):
+    """
+    Add decorations to PNG QR based on personalization mode. Draws on
+    ``img`` in place, so pass an image the caller owns.
+    """
+    if not (add_frame or draws_personalization(personalization_mode, content_type, content)):
+        return img
+
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    # One Draw shared by the frame and the helpers that paint on img itself
+    draw = ImageDraw.Draw(img)
     
     # Legacy frame (can be used with any mode)
     if add_frame:
-        draw = ImageDraw.Draw(img)
         w, h = img.size
         size = min(w, h)
         margin = int(size * 0.035)
         rect = (margin, margin, w - margin, h - margin)
         width = max(2, int(size * 0.015))
         radius = int(size * 0.06)
-        try:
-            draw.rounded_rectangle(rect, radius=radius, outline=fg_color, width=width)
-        except AttributeError:
-            draw.rectangle(rect, outline=fg_color, width=width)
+        draw.rounded_rectangle(rect, radius=radius, outline=fg_rgb, width=width)
     
     # Apply personalization mode
     if personalization_mode == "minimal":
-        img = add_minimal_personalization(img, content_type, content, fg_color, bg_color)
+        img = add_minimal_personalization(img, content_type, content, fg_rgb, bg_rgb)
     elif personalization_mode == "focal":
-        img = add_focal_personalization(img, content_type, content, fg_color, bg_color)
+        img = add_focal_personalization(img, content_type, content, fg_rgb, bg_rgb, draw=draw)
     elif personalization_mode == "easter_egg":
-        img = add_easter_egg_personalization(img, content_type, content, fg_color)
+        img = add_easter_egg_personalization(img, content_type, content, fg_rgb, draw=draw)
     
     return img
 
 
-def make_qr(
+class UploadedContent:
+    """
+    Hashable wrapper around an uploaded logo/photo, keyed by the sha256 of
+    its file bytes so identical uploads share a cache entry.
+    """
+
+    __slots__ = ("digest", "content")
+
+    def __init__(self, content, digest: bytes = None):
+        self.content = content
+        if digest is None:
+            if isinstance(content, Image.Image):
+                # No file to hash; a PNG of it also carries palette and transparency
+                payload = encode_png(content)
+            else:
+                with open(content, "rb") as fh:
+                    payload = fh.read()
+            digest = hashlib.sha256(payload).digest()
+        self.digest = digest
+
+    def release(self):
+        # The cache keeps the key alive; don't keep the upload with it
+        self.content = None
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, UploadedContent) and other.digest == self.digest
+
+
+def segment_bits(segment, version: int = 40) -> int:
+    """Bits one QRData segment takes in a code of ``version``, header included."""
+    n = len(segment)
+    if segment.mode == qr_util.MODE_NUMBER:
+        # 10 bits per 3 digits; a trailing 1 or 2 digits takes 4 or 7 bits
+        data_bits = n // 3 * 10 + (qr_util.NUMBER_LENGTH[n % 3] if n % 3 else 0)
+    elif segment.mode == qr_util.MODE_ALPHA_NUM:
+        # 11 bits per 2 characters; a trailing one takes 6 bits
+        data_bits = n // 2 * 11 + (6 if n % 2 else 0)
+    else:
+        data_bits = n * 8
+    return 4 + qr_util.length_in_bits(segment.mode, version) + data_bits
+
+
+def qr_segments(data: str, error_correction: int) -> list:
+    """
+    Split ``data`` into segments the way qrcode's add_data() does, and
+    reject it before any QR work if even version 40 can't hold them.
+    """
+    segments = list(qr_util.optimal_data_chunks(data, minimum=20))
+    bits = sum(segment_bits(segment) for segment in segments)
+    limit = qr_util.BIT_LIMIT_TABLE[error_correction][40]
+    if bits > limit:
+        raise ValueError(
+            f"Data is too long for a QR code (needs {bits} bits; "
+            f"at most {limit} fit)")
+    return segments
+
+
+def build_qr(data: str, box_size: int, border: int, error_correction: int = ERROR_CORRECTION,
+             mask_pattern=MASK_PATTERN):
+    qr = qrcode.QRCode(
+        version=None,
+        error_correction=error_correction,
+        box_size=box_size,
+        border=border,
+        mask_pattern=mask_pattern,
+    )
+    for segment in qr_segments(data, error_correction):
+        qr.add_data(segment)
+    qr.make(fit=True)
+    return qr
+
+
+@functools.lru_cache(maxsize=256)
+def qr_matrix(data: str, error_correction: int, mask_pattern=MASK_PATTERN):
+    """
+    Encoded module matrix (no quiet zone) for ``data``. Shared by every
+    size and colour of the same data, so it is returned read-only.
+    """
+    qr = build_qr(data, box_size=1, border=0, error_correction=error_correction,
+                  mask_pattern=mask_pattern)
+    modules = np.array(qr.modules, dtype=np.uint8)
+    modules.flags.writeable = False
+    return modules
+
+
+@functools.lru_cache(maxsize=MONO_CACHE_SIZE)
+def render_mono_qr(data: str, error_correction: int, border: int):
+    """
+    Module image (0 = light, 1 = dark) at one pixel per module, shared by
+    every size and colour of the same code. Kept at module resolution so a
+    cache entry stays a few tens of kB; colorize_qr() upscales it. Cached,
+    so callers must not modify it in place. Decorations get drawn over
+    these codes, so qrcode picks the mask (see MASK_PATTERN).
+    """
+    modules = qr_matrix(data, error_correction, mask_pattern=None)
+    return Image.fromarray(np.pad(modules, border))
+
+
+def colorize_qr(mono, box_size: int, fg_rgb, bg_rgb):
+    """
+    Colour a render_mono_qr() image through a two-entry palette and upscale
+    it to ``box_size`` pixels a module. Colours are RGB, or RGBA for both
+    to get an RGBA image.
+    """
+    mode = "RGBA" if len(bg_rgb) == 4 else "RGB"
+    img = mono.copy()
+    img.putpalette((*bg_rgb, *fg_rgb), rawmode=mode)
+    # Still a one-byte palette image while it is scaled up
+    size = (mono.width * box_size, mono.height * box_size)
+    img = img.resize(size, Image.Resampling.NEAREST)
+    return img.convert(mode)
+
+
+class RenderCache:
+    """
+    Thread-safe LRU of rendered (payload, mimetype, filename) results,
+    bounded by entry count and by the payloads' total size. Payloads over
+    ``max_entry_bytes`` are never stored.
+    """
+
+    def __init__(self, maxsize: int, max_bytes: int, max_entry_bytes: int):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, key, result):
+        nbytes = len(result[0])
+        if nbytes > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._entries[key] = result
+            self.size += nbytes
+            while len(self._entries) > self.maxsize or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+_render_cache = RenderCache(QR_CACHE_SIZE, QR_CACHE_BYTES, QR_CACHE_MAX_ENTRY)
+_upload_render_cache = RenderCache(UPLOAD_CACHE_SIZE, UPLOAD_CACHE_BYTES, QR_CACHE_MAX_ENTRY)
+
+
+def render_qr(
     data: str,
     box_size: int = 10,
     border: int = 4,
@@ -297,9 +616,9 @@ def make_qr(
     personalization_mode: str = "none",
     content_type: str = "text",
     content = None,
-) -> tuple[str, str]:
+) -> tuple[bytes, str, str]:
     """
-    Generate a QR code and return (data_url, suggested_filename).
+    Generate a QR code and return (image_bytes, mimetype, suggested_filename).
     """
     if not data:
         raise ValueError("No data provided")
@@ -308,146 +627,174 @@ def make_qr(
     bg_color = hex_or_default(bg_color, "#ffffff")
     fg_color, bg_color = apply_style_preset(style_preset, fg_color, bg_color)
 
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=box_size,
-        border=border,
-    )
-    qr.add_data(data)
-    qr.make(fit=True)
+    # Normalize away options that don't affect the output so they share entries
+    if image_format == "svg":
+        add_frame = False
+        personalization_mode = "none"
+    if not draws_personalization(personalization_mode, content_type, content):
+        personalization_mode, content_type, content = "none", "text", None
+    elif content_type in ["logo", "image"] and content:
+        if not isinstance(content, UploadedContent):
+            content = UploadedContent(content)
+
+    key = (data, box_size, border, fg_color, bg_color, transparent_bg,
+           image_format, add_frame, personalization_mode, content_type, content)
+    cache = _upload_render_cache if isinstance(content, UploadedContent) else _render_cache
+    try:
+        result = cache.get(key)
+        if result is None:
+            result = _render_qr(*key)
+            cache.put(key, result)
+        return result
+    finally:
+        if isinstance(content, UploadedContent):
+            content.release()
+
+
+def _render_qr(data, box_size, border, fg_color, bg_color, transparent_bg,
+               image_format, add_frame, personalization_mode, content_type,
+               content) -> tuple[bytes, str, str]:
+    if isinstance(content, UploadedContent):
+        content = content.content
+
+    # Parse the colours once for rendering and decorations
+    fg_rgb = ImageColor.getrgb(fg_color)
+    bg_rgb = ImageColor.getrgb(bg_color)
 
     # SVG (no decorations)
     if image_format == "svg":
-        img = qr.make_image(
-            image_factory=SvgImage,
-            fill_color=fg_color,
-            back_color="transparent" if transparent_bg else bg_color,
-        )
-        buffer = io.BytesIO()
-        img.save(buffer)
-        svg_bytes = buffer.getvalue()
-        data_url = svg_to_base64(svg_bytes)
-        return data_url, "qr-code.svg"
-
-    # PNG
-    img = qr.make_image(fill_color=fg_color, back_color=bg_color).convert("RGBA")
-
-    # Transparent background
+        svg = encode_qr_svg(qr_matrix(data, ERROR_CORRECTION), box_size, border,
+                            fg_rgb, bg_rgb, transparent_bg)
+        return svg, "image/svg+xml", "qr-code.svg"
+
+    # Plain codes skip Pillow and go straight from the matrix to PNG bytes
+    if not (add_frame or personalization_mode != "none"):
+        png = encode_qr_png(qr_matrix(data, ERROR_CORRECTION), box_size, border,
+                            fg_rgb, bg_rgb, transparent_bg)
+        return png, "image/png", "qr-code.png"
+
+    # Only the palette depends on the colours; transparency is part of it
+    mono = render_mono_qr(data, ERROR_CORRECTION, border)
     if transparent_bg:
-        datas = img.getdata()
-        new_data = []
-        bg_pixel = datas[0]
-        for pixel in datas:
-            if pixel[:3] == bg_pixel[:3]:
-                new_data.append((255, 255, 255, 0))
-            else:
-                new_data.append(pixel)
-        img.putdata(new_data)
+        img = colorize_qr(mono, box_size, fg_rgb + (255,), (255, 255, 255, 0))
+    else:
+        img = colorize_qr(mono, box_size, fg_rgb, bg_rgb)
 
     # Add decorations
-    if add_frame or personalization_mode != "none":
-        img = decorate_png_qr(img, fg_color, add_frame, personalization_mode,
-                             content_type, content, bg_color)
+    img = decorate_png_qr(img, fg_rgb, add_frame, personalization_mode,
+                          content_type, content, bg_rgb)
+
+    return encode_png(img), "image/png", "qr-code.png"
+
+
+def make_qr(data: str, **options) -> tuple[str, str]:
+    """
+    Generate a QR code and return (data_url, suggested_filename). Takes the
+    same options as render_qr().
+    """
+    payload, mimetype, filename = render_qr(data, **options)
+    return to_data_url(payload, mimetype), filename
+
+
+def read_form(values) -> dict:
+    """QR options from a submitted form or query string, named as in the template."""
+    return {
+        "input_data": values.get("data", "").strip(),
+        # Same bounds as the form inputs; also caps the worst-case image size
+        "box_size": int_or_default(values.get("box_size"), 10, 4, 40),
+        "border": int_or_default(values.get("border"), 4, 1, 10),
+        "fg_color": values.get("fg_color", "#000000"),
+        "bg_color": values.get("bg_color", "#ffffff"),
+        "transparent_bg": bool(values.get("transparent_bg")),
+        "image_format": values.get("image_format", "png"),
+        "style_preset": values.get("style_preset", "classic"),
+        "add_frame": bool(values.get("add_frame")),
+        "personalization_mode": values.get("personalization_mode", "none"),
+        "content_type": values.get("content_type", "text"),
+        "initials": values.get("initials", "").strip(),
+    }
 
-    data_url = png_to_base64(img)
-    return data_url, "qr-code.png"
+
+def render_form(form: dict, content=None) -> tuple[bytes, str, str]:
+    return render_qr(
+        data=form["input_data"],
+        box_size=form["box_size"],
+        border=form["border"],
+        fg_color=form["fg_color"],
+        bg_color=form["bg_color"],
+        transparent_bg=form["transparent_bg"],
+        image_format=form["image_format"],
+        style_preset=form["style_preset"],
+        add_frame=form["add_frame"],
+        personalization_mode=form["personalization_mode"],
+        content_type=form["content_type"],
+        content=content,
+    )
 
 
 @app.route("/", methods=["GET", "POST"])
 def index():
-    qr_data_url = None
+    qr_src = None
     filename = None
     error = None
-
-    # Default form values
-    input_data = ""
-    box_size = 10
-    border = 4
-    fg_color = "#000000"
-    bg_color = "#ffffff"
-    transparent_bg = False
-    image_format = "png"
-    style_preset = "classic"
-    add_frame = True
-    personalization_mode = "none"
-    content_type = "text"
-    initials = ""
+    form = FORM_DEFAULTS
 
     if request.method == "POST":
-        input_data = request.form.get("data", "").strip()
-        box_size = int(request.form.get("box_size", 10) or 10)
-        border = int(request.form.get("border", 4) or 4)
-        fg_color = request.form.get("fg_color", "#000000")
-        bg_color = request.form.get("bg_color", "#ffffff")
-        transparent_bg = bool(request.form.get("transparent_bg"))
-        image_format = request.form.get("image_format", "png")
-        style_preset = request.form.get("style_preset", "classic")
-        add_frame = bool(request.form.get("add_frame"))
-        personalization_mode = request.form.get("personalization_mode", "none")
-        content_type = request.form.get("content_type", "text")
-        initials = request.form.get("initials", "").strip()
-
-        # Handle content based on type
-        content = None
-        
-        if content_type == "text":
-            content = initials
-        elif content_type == "logo" and 'logo_upload' in request.files:
-            file = request.files['logo_upload']
-            if file and file.filename and allowed_file(file.filename):
-                filename_safe = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename_safe)
-                file.save(filepath)
-                content = filepath
-        elif content_type == "image" and 'photo_upload' in request.files:
-            file = request.files['photo_upload']
-            if file and file.filename and allowed_file(file.filename):
-                filename_safe = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename_safe)
-                file.save(filepath)
-                content = filepath
+        form = read_form(request.form)
+        content_type = form["content_type"]
 
         try:
-            qr_data_url, filename = make_qr(
-                data=input_data,
-                box_size=box_size,
-                border=border,
-                fg_color=fg_color,
-                bg_color=bg_color,
-                transparent_bg=transparent_bg,
-                image_format=image_format,
-                style_preset=style_preset,
-                add_frame=add_frame,
-                personalization_mode=personalization_mode,
-                content_type=content_type,
-                content=content,
-            )
-            
-            # Clean up uploaded files
-            if content and isinstance(content, str) and os.path.exists(content):
-                os.remove(content)
-                
+            # Handle content based on type (uploads stay in memory)
+            content = None
+
+            if content_type == "text":
+                content = form["initials"]
+            elif content_type == "logo" and 'logo_upload' in request.files:
+                file = request.files['logo_upload']
+                if file and file.filename and allowed_file(file.filename):
+                    content = load_upload(file)
+            elif content_type == "image" and 'photo_upload' in request.files:
+                file = request.files['photo_upload']
+                if file and file.filename and allowed_file(file.filename):
+                    content = load_upload(file)
+
+            payload, mimetype, filename = render_form(form, content)
+
+            # PNGs the query string can reproduce are fetched from /qr.png
+            # (hitting the render cache) rather than inlined as base64
+            if mimetype == "image/png" and not isinstance(content, UploadedContent):
+                qr_src = url_for("qr_png", **request.form.to_dict())
+            if not qr_src or len(qr_src) > MAX_QR_URL_LENGTH:
+                qr_src = to_data_url(payload, mimetype)
         except Exception as e:
             error = str(e)
 
     return render_template(
         "index.html",
-        qr_data_url=qr_data_url,
+        qr_src=qr_src,
         filename=filename,
         error=error,
-        input_data=input_data,
-        box_size=box_size,
-        border=border,
-        fg_color=fg_color,
-        bg_color=bg_color,
-        transparent_bg=transparent_bg,
-        image_format=image_format,
-        style_preset=style_preset,
-        add_frame=add_frame,
-        personalization_mode=personalization_mode,
-        content_type=content_type,
-        initials=initials,
+        **form,
+    )
+
+
+@app.route("/qr.png")
+def qr_png():
+    form = read_form(request.args)
+    form["image_format"] = "png"
+    content = form["initials"] if form["content_type"] == "text" else None
+
+    try:
+        payload, mimetype, filename = render_form(form, content)
+    except Exception as e:
+        abort(400, description=str(e))
+
+    return send_file(
+        io.BytesIO(payload),
+        mimetype=mimetype,
+        download_name=filename,
+        etag=hashlib.sha256(payload).hexdigest(),
+        max_age=3600,
     )
 
 